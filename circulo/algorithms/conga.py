@@ -1,10 +1,10 @@
 import numpy as np
+import scipy.sparse as sp
 import collections as co
 import igraph as ig
 import operator
-import itertools
 import argparse
-from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 
 import circulo.algorithms.overlap
@@ -17,12 +17,19 @@ import circulo.algorithms.overlap
 #   * Keep a record of splits or merges?
 #       * Right now, we store a lot of redundant information with a new
 #           VertexCover item for every split.
+#   * Edge betweennesses could be cached and patched after each edge
+#       deletion, recounting only the pairs whose shortest paths used the
+#       edge. That was tried and left out: the subtract-and-re-add drift
+#       changes which of several tied edges gets removed, for a 5-14% gain.
 
-def conga(OG, calculate_modularities=None, optimal_count=None):
+def conga(OG, calculate_modularities=None, optimal_count=None, workers=1):
     """
     Defines the CONGA algorithm outlined in the Gregory 2007 paper
     (An Algorithm to Find Overlapping Community Structure in Networks)
 
+    workers is the number of threads used to compute pair betweennesses.
+    It defaults to 1, since run_algos already runs one process per core.
+
     Returns a CrispOverlap object of all of the covers.
     """
 
@@ -35,11 +42,14 @@ def conga(OG, calculate_modularities=None, optimal_count=None):
 
     # Store the original ids of all vertices
     G.vs['CONGA_orig'] = [i.index for i in OG.vs]
+    # Component membership is kept up to date by check_for_split, so the
+    # components don't need to be found again after every split.
+    G.vs['CONGA_comm'] = comm.membership
     allCovers = {nClusters : ig.VertexCover(OG)}
     while G.es:
-        split = remove_edge_or_split_vertex(G)
+        split = remove_edge_or_split_vertex(G, workers)
         if split:
-            comm = G.components().membership
+            comm = G.vs['CONGA_comm']
             cover = get_cover(G, OG, comm)
             nClusters += 1
             # short circuit stuff would go here.
@@ -50,7 +60,7 @@ def conga(OG, calculate_modularities=None, optimal_count=None):
                                     optimal_count=optimal_count)
 
 
-def remove_edge_or_split_vertex(G):
+def remove_edge_or_split_vertex(G, workers=1):
     """
     The heart of the CONGA algorithm. Decides which edge should be
     removed or which vertex should be split. Returns True if the
@@ -61,10 +71,9 @@ def remove_edge_or_split_vertex(G):
     eb = G.edge_betweenness()
 
     maxIndex, maxEb = max(enumerate(eb), key=operator.itemgetter(1))
-    # We might be able to calculate vertex betweenness and edge
-    # betweenness at the same time. The current implementation is slower
-    # than the builtin, though.
-    vb = G.betweenness()
+    # Vertex betweenness follows from the edge betweenness, which saves
+    # a second all-pairs shortest path pass.
+    vb = vertex_betweenness_from_edges(G, eb)
 
     # Only consider vertices with vertex betweenness >= max
     # edge betweenness. From Gregory 2007 step 3
@@ -75,8 +84,10 @@ def remove_edge_or_split_vertex(G):
     if not vi:
         split = delete_edge(G, edge)
     else:
-        pb = pair_betweenness(G, vi)
-        maxSplit, vNum, splitInstructions = max_split_betweenness(G, pb)
+        # the cliques are indexed by position in these lists, so both steps share them
+        neighbors = {v : G.neighbors(v) for v in vi}
+        pb = pair_betweenness(G, vi, workers=workers, neighbors=neighbors)
+        maxSplit, vNum, splitInstructions = max_split_betweenness(G, pb, neighbors)
         if maxSplit > maxEb:
             split = split_vertex(G, vNum, splitInstructions[0])
         else:
@@ -84,15 +95,44 @@ def remove_edge_or_split_vertex(G):
     return split
 
 
+def component_membership(G):
+    """
+    Returns the component membership list of G, read from the 'CONGA_comm'
+    attribute kept by conga when it is there.
+    """
+    if 'CONGA_comm' in G.vs.attributes():
+        return G.vs['CONGA_comm']
+    return G.components().membership
+
+
+def vertex_betweenness_from_edges(G, eb):
+    """
+    Given a graph and its edge betweennesses, returns the vertex betweennesses.
+
+    Every shortest path through v uses two of its edges and every shortest
+    path ending at v uses one, so the edge betweennesses around v add up to
+    2 * vb[v] + (size of v's component - 1).
+    """
+    edges = np.array(G.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+    incident = np.bincount(edges.ravel(), weights=np.repeat(eb, 2), minlength=G.vcount())
+    membership = component_membership(G)
+    endpoints = np.bincount(membership)[membership] - 1
+    # round away float noise so that a vertex tied with the max edge
+    # betweenness is not let in by it.
+    return np.round((incident - endpoints) / 2, 9)
+
+
 def get_cover(G, OG, comm):
     """
     Given the graph, the original graph, and a community
     membership list, returns a vertex cover of the communities
     referring back to the original community.
     """
+    # read the whole attribute column at once rather than one vertex at a time
+    orig = G.vs['CONGA_orig']
     coverDict = co.defaultdict(list)
-    for i, community in enumerate(comm):
-        coverDict[community].append(int(G.vs[i]['CONGA_orig']))
+    for community, v in zip(comm, orig):
+        coverDict[community].append(int(v))
     return ig.clustering.VertexCover(OG, clusters=list(coverDict.values()))
 
 
@@ -108,12 +148,20 @@ def delete_edge(G, edge):
 def check_for_split(G, edge):
     """
     Given an edge in tuple form, check if it splits the
-    graph into two disjoint clusters. If so, it returns
-    True. Otherwise, False.
+    graph into two disjoint clusters. If so, it moves the
+    side holding edge[0] to a new 'CONGA_comm' component
+    (when G has that attribute) and returns True. Otherwise, False.
     """
     # Possibly keep a record of splits.
     if edge[0] == edge[1]: return False
-    return not G.edge_disjoint_paths(source=edge[0], target=edge[1])
+    # A single BFS is enough to tell whether the endpoints are still
+    # connected; there is no need for a max-flow.
+    side = G.subcomponent(edge[0])
+    if edge[1] in side:
+        return False
+    if 'CONGA_comm' in G.vs.attributes():
+        G.vs[side]['CONGA_comm'] = max(G.vs['CONGA_comm']) + 1
+    return True
 
 
 def split_vertex(G, v, splitInstructions):
@@ -125,93 +173,154 @@ def split_vertex(G, v, splitInstructions):
     new_index = G.vcount()
     G.add_vertex()
     G.vs[new_index]['CONGA_orig'] = G.vs[v]['CONGA_orig']
-
-    # adding all relevant edges to new vertex, deleting from old one.
-    for partner in splitInstructions:
-        G.add_edge(new_index, partner)
-        G.delete_edges((v, partner))
+    if 'CONGA_comm' in G.vs.attributes():
+        G.vs[new_index]['CONGA_comm'] = G.vs[v]['CONGA_comm']
+
+    # moving all relevant edges from the old vertex to the new one, in one
+    # igraph call each rather than two per edge. Edges are deleted by id, so
+    # a partner listed once per parallel edge gives up every one of them.
+    moved = []
+    for partner, count in co.Counter(splitInstructions).items():
+        moved += G.es.select(_between=([v], [partner])).indices[:count]
+    G.delete_edges(moved)
+    G.add_edges([(new_index, partner) for partner in splitInstructions])
 
     # check if the two new vertices are disconnected.
     return check_for_split(G, (v, new_index))
 
 
-def order_tuple(toOrder):
-    """
-    Given a tuple (a, b), returns (a, b) if a <= b,
-    else (b, a).
-    """
-    if toOrder[0] <= toOrder[1]:
-        return toOrder
-    return (toOrder[1], toOrder[0])
-
-
-def update_betweenness(G, path, pair, count, relevant):
-    """
-    Given a shortest path in G, along with a count of paths
-    that length, to determine weight, updates the edge and
-    pair betweenness dicts with the path's new information.
-    """
-    weight = 1./count
-    pos = 0
-    while pos < len(path) - 2:
-        if path[pos + 1] in relevant:
-            pair[path[pos + 1]][order_tuple((path[pos], path[pos + 2]))] += weight
-        pos += 1
-
-
-def pair_betweenness(G, relevant):
+def adjacency_csr(G):
+    """
+    Returns the symmetric adjacency matrix of G in CSR form. Parallel
+    edges are summed, so they count as distinct shortest paths.
+    """
+    n = G.vcount()
+    edges = np.array(G.get_edgelist(), dtype=np.int32).reshape(-1, 2)
+    rows = np.concatenate((edges[:, 0], edges[:, 1]))
+    cols = np.concatenate((edges[:, 1], edges[:, 0]))
+    data = np.ones(len(rows))
+    return sp.csr_matrix((data, (rows, cols)), shape=(n, n))
+
+
+def brandes_pair_matrices(A, sources, neighbors):
+    """
+    Runs Brandes' algorithm from every vertex in sources at once, one BFS
+    level at a time, using the CSR adjacency matrix A.
+
+    neighbors maps each vertex of interest to its list of neighbors. Returns
+    a dict {v : M} for every such v, where M[i, j] is the pair dependency of
+    the sources on paths that enter v from neighbors[v][i] and leave through
+    neighbors[v][j]. Only targets greater than
+    the source are counted, so each pair of endpoints is seen once.
+    """
+    b, n = len(sources), A.shape[0]
+    rows = np.arange(b)
+
+    # BFS distances and the number of shortest paths from each source to
+    # each vertex come out of the same level by level expansion.
+    dist = np.full((b, n), np.inf)
+    dist[rows, sources] = 0
+    sigma = np.zeros((b, n))
+    sigma[rows, sources] = 1
+    frontier = sigma.copy()
+    maxDist = 0
+    while True:
+        paths = (A @ frontier.T).T
+        level = (paths > 0) & np.isinf(dist)
+        if not level.any():
+            break
+        maxDist += 1
+        dist[level] = maxDist
+        sigma[level] = paths[level]
+        frontier = np.where(level, sigma, 0)
+
+    # coeff[s, w] is the dependency of s on w per shortest path to w,
+    # counting w itself as a target when it is greater than s.
+    isTarget = np.arange(n)[None, :] > np.asarray(sources)[:, None]
+    delta = np.zeros((b, n))
+    coeff = np.zeros((b, n))
+    for d in range(maxDist, 0, -1):
+        level = dist == d
+        coeff[level] = (isTarget[level] + delta[level]) / sigma[level]
+        delta += np.where(dist == d - 1, sigma * (A @ (coeff * level).T).T, 0)
+
+    matrices = {}
+    for v, vNeighbors in neighbors.items():
+        vDist = dist[:, [v]]
+        preds = np.where(dist[:, vNeighbors] + 1 == vDist, sigma[:, vNeighbors], 0)
+        succs = np.where(dist[:, vNeighbors] == vDist + 1, coeff[:, vNeighbors], 0)
+        matrices[v] = preds.T @ succs
+    return matrices
+
+
+def pair_betweenness(G, relevant, batch_size=None, workers=1, neighbors=None):
     """
     Returns a dictionary of the pair betweenness of all vertices in relevant.
 
-    The structure of the returned dictionary is dic[v][(u, w)] = c, where c
-    is the number of shortest paths traverse through u, v, w.
-    """
-    pair_betweenness = {vertex : {uw : 0 for uw in itertools.combinations(G.neighbors(vertex), 2)} for vertex in relevant}
-
-    for i in G.vs:
-        pathCounts = Counter()
-        # Only find the shortest paths that we haven't already seen
-        shortest_paths_from_v = G.get_all_shortest_paths(i, to=G.vs[i.index+1:]) # here too. need all shortest paths. too bad.
-        for path in shortest_paths_from_v: # reads twice. Can I get it down to once?
-            pathCounts[path[-1]] += 1
-        for path in shortest_paths_from_v:
-            update_betweenness(G, path, pair_betweenness, pathCounts[path[-1]], set(relevant))
+    The structure of the returned dictionary is dic[v][i, j] = c, where c is
+    the number of shortest paths traverse through u, v, w, with u and w the
+    ith and jth entries of neighbors[v]. Each dic[v] is therefore the
+    k-clique of v's neighbors discussed on page 5 of the CONGA paper.
+    neighbors maps each relevant vertex to G.neighbors(v), and is looked up
+    if not given.
+
+    Sources are processed in batches of batch_size (by default, enough to
+    keep each n x batch_size work matrix around a million entries). With
+    workers > 1 the sources are spread over at least that many batches,
+    which run on a thread pool; the numpy and scipy kernels release the GIL.
+    """
+    # Only components holding a relevant vertex have shortest paths through
+    # one, so the rest of the graph is left out. Vertex order is kept, so
+    # neighbor lists and the t > s rule carry over to the subgraph.
+    membership = component_membership(G)
+    wanted = {membership[v] for v in relevant}
+    keep = [i for i, c in enumerate(membership) if c in wanted]
+    H = G.induced_subgraph(keep) if len(keep) < G.vcount() else G
+    local = {v : i for i, v in enumerate(keep)}
+
+    # Only targets greater than the source are counted, so the greatest
+    # vertex of each component has nothing to add as a source.
+    last = {membership[v] : i for i, v in enumerate(keep)}
+    sources = [i for i, v in enumerate(keep) if i != last[membership[v]]]
+
+    n = H.vcount()
+    if batch_size is None:
+        batch_size = max(1, 2**20 // n)
+    if workers > 1:
+        batch_size = min(batch_size, -(-len(sources) // workers))
+    batches = [sources[start:start + batch_size] for start in range(0, len(sources), batch_size)]
+    A = adjacency_csr(H)
+
+    if neighbors is None:
+        neighbors = {v : G.neighbors(v) for v in relevant}
+    localNeighbors = {local[v] : [local[w] for w in neighbors[v]] for v in relevant}
+    run = lambda batch: brandes_pair_matrices(A, batch, localNeighbors)
+    if workers > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(run, batches))
+    else:
+        results = map(run, batches)
+
+    totals = {v : 0 for v in localNeighbors}
+    for matrices in results:
+        for v, M in matrices.items():
+            totals[v] = totals[v] + M
+
+    pair_betweenness = {}
+    for v in relevant:
+        M = totals[local[v]]
+        clique = M + M.T
+        # Ignore any self loops if they're there.
+        np.fill_diagonal(clique, 0)
+        pair_betweenness[v] = clique
     return pair_betweenness
 
 
-def create_clique(G, v, pb):
+def max_split_betweenness(G, dic, neighbors=None):
     """
-    Given a vertex and its pair betweennesses, returns a k-clique
-    representing all of its neighbors, with edge weights determined by the pair
-    betweenness scores. Algorithm discussed on page 5 of the CONGA paper.
-    """
-    neighbors = G.neighbors(v)
-
-    # map each neighbor to its index in the adjacency matrix
-    mapping = {neigh : i for i, neigh in enumerate(neighbors)}
-    n = len(neighbors)
-
-    # Can use ints instead: (dtype=int). Only works if we use matrix_min
-    # instead of mat_min.
-    clique = np.matrix(np.zeros((n, n)))
-
-    for uw, score in pb.items():
-
-
-        clique[mapping[uw[0]], mapping[uw[1]]] = score
-        clique[mapping[uw[1]], mapping[uw[0]]] = score
-
-    # Ignore any self loops if they're there. If not, this line
-    # does nothing and can be removed.
-    np.fill_diagonal(clique, 0)
-    return clique
-
-
-
-def max_split_betweenness(G, dic):
-    """
-    Given a dictionary of vertices and their pair betweenness scores, uses the greedy
+    Given a dictionary of vertices and their pair betweenness cliques, uses the greedy
     algorithm discussed in the CONGA paper to find a (hopefully) near-optimal split.
+    neighbors optionally holds the neighbor lists the cliques were built from.
 
     Returns a 3-tuple (vMax, vNum, vSpl) where vMax is the max split betweenness,
     vNum is the vertex with said split betweenness, and vSpl is a list of which
@@ -221,87 +330,74 @@ def max_split_betweenness(G, dic):
     # for every vertex of interest, we want to figure out the maximum score achievable
     # by splitting the vertices in various ways, and return that optimal split
     for v in dic:
-        clique = create_clique(G, v,dic[v])
-
-        # initialize a list on how we will map the neighbors to the collapsing matrix
-        vMap = [[ve] for ve in G.neighbors(v)]
-
-        # we want to keep collapsing the matrix until we have a 2x2 matrix and its
-        # score. Then we want to remove index j from our vMap list and concatenate
-        # it with the vMap[i]. This begins building a way of keeping track of how
-        # we are splitting the vertex and its neighbors
-        while clique.size > 4:
-            i,j,clique = reduce_matrix(clique)
-            vMap[i] += vMap.pop(j)
-        if clique[0,1] >= vMax:
-            vMax = clique[0,1]
+        score, groups = collapse_clique(dic[v])
+        if score >= vMax:
+            vNeighbors = neighbors[v] if neighbors is not None else G.neighbors(v)
+            vMax = score
             vNum = v
-            vSpl = vMap
+            vSpl = [[vNeighbors[i] for i in group] for group in groups]
     return vMax,vNum,vSpl
 
 
-def matrix_min(mat):
+def collapse_clique(clique):
     """
-    Given a symmetric matrix, find an index of the minimum value
-    in the upper triangle (not including the diagonal.)
+    Given a symmetric clique matrix, keeps collapsing the pair with the lowest score
+    until two groups are left. Works on the flattened upper triangle in place, so no
+    step reallocates the matrix.
+
+    Returns the score between the two groups and a list of the clique indices in each.
     """
-    # Currently, this function is unused, as its result is
-    # the same as that of mat_min, and it is not always
-    # faster. Left in for reference in case mat_min becomes
-    # a bottleneck.
+    k = clique.shape[0]
+    rows, cols = np.triu_indices(k, 1)
+    nPairs = len(rows)
 
-    # find the minimum from the upper triangular matrix
-    # (not including the diagonal)
-    upperTri = np.triu_indices(mat.shape[0], 1)
-    minDex = mat[upperTri].argmin()
+    # tri holds one score per pair plus an infinite sentinel at the end. pairIndex[a, b]
+    # is the position of the pair {a, b} in tri, and the diagonal points at the
+    # sentinel, so whole rows of pairIndex can be used without masking out a or b.
+    tri = np.empty(nPairs + 1)
+    tri[:nPairs] = clique[rows, cols]
+    tri[nPairs] = np.inf
+    pairIndex = np.full((k, k), nPairs)
+    pairIndex[rows, cols] = np.arange(nPairs)
+    pairIndex[cols, rows] = np.arange(nPairs)
 
-    # find the index in the big matrix. TODO: do so
-    # with some algebra.
-    triN = mat.shape[0] - 1
-    row = 0
-    while minDex >= triN:
-        minDex -= triN
-        triN -= 1
-        row += 1
-    col = mat.shape[0] - triN + minDex
-    return row, col
+    # we want to keep collapsing until only two groups are left. Each collapse
+    # folds group j into group i, which keeps track of how we are splitting
+    # the vertex and its neighbors
+    groups = [[i] for i in range(k)]
+    for _ in range(k - 2):
+        i, j = mat_min(tri, rows, cols)
+        reduce_matrix(tri, pairIndex, i, j)
+        groups[i] += groups[j]
+        groups[j] = None
 
+    a, b = [i for i, group in enumerate(groups) if group is not None]
+    return tri[pairIndex[a, b]], [groups[a], groups[b]]
 
-def mat_min(M):
+
+def mat_min(tri, rows, cols):
     """
-    Given a matrix, find an index of the minimum value (not including the
-    diagonal).
+    Given the flattened upper triangle of a matrix and the row and column of each
+    of its entries, find an index of the minimum value.
     """
-    # take a matrix we pass in, and fill the diagonal with the matrix max. This is
-    # so that we don't grab any values from the diag.
-    np.fill_diagonal(M, float('inf'))
-
-    # figure out the indices of the cell with the lowest value.
-    i,j = np.unravel_index(M.argmin(), M.shape)
-    np.fill_diagonal(M,0)
-    return i, j
+    minDex = tri.argmin()
+    return rows[minDex], cols[minDex]
 
 
-def reduce_matrix(M):
+def reduce_matrix(tri, pairIndex, i, j):
     """
-    Given a matrix M, collapses the row and column of the minimum value. This is just
-    an adjacency matrix way of implementing the greedy "collapse" discussed in CONGA.
+    Given the flattened upper triangle of a matrix, collapses index j into index i in
+    place. This is just an adjacency matrix way of implementing the greedy "collapse"
+    discussed in CONGA. Collapsed indices are left with infinite scores so that they
+    are never picked again.
 
-    Returns the new matrix and the collapsed indices.
+    The diagonal of pairIndex must point at an infinite sentinel entry of tri: the
+    pair {i, j} itself then picks up an infinite score, and the sentinel stays infinite.
     """
-    i,j = mat_min(M)
-    #i, j = matrix_min(M)
-    # add the ith row to the jth row and overwrite the ith row with those values
-    M[i,:] = M[j,:] + M[i,:]
-
-    # delete the jth row
-    M = np.delete(M, (j), axis=0)
-
-    # similarly with the columns
-    M[:,i] = M[:,j] + M[:,i]
-    M = np.delete(M, (j), axis=1)
-    np.fill_diagonal(M,0) # not sure necessary.
-    return i,j,M
+    rowI = pairIndex[i]
+    rowJ = pairIndex[j]
+    tri[rowI] += tri[rowJ]
+    tri[rowJ] = np.inf
 
 
 def pretty_print_cover(G, cover, label='CONGA_index'):
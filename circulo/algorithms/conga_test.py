@@ -0,0 +1,178 @@
+import circulo.algorithms.conga as CONGA
+import unittest
+import igraph
+import numpy as np
+
+class TestCongaFunctions(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Initializes the graph for testing to Zachary's
+        karate club.
+        """
+        self.graph = igraph.Graph.Famous("zachary")
+        self.graph.vs['CONGA_orig'] = [i.index for i in self.graph.vs]
+
+
+    def tearDown(self):
+        self.graph = None
+
+
+    def test_vertex_betweenness_from_edges(self):
+        """
+        Checks that vertex_betweenness_from_edges yields the same
+        results as igraph's graph.betweenness, also on a disconnected
+        graph and on a multigraph with self loops.
+        """
+        disconnected = self.graph.disjoint_union(igraph.Graph.Famous("petersen"))
+        disconnected.add_vertices(2)
+        multigraph = self.graph.copy()
+        multigraph.add_edges([(0, 1), (0, 1), (5, 16), (2, 2), (33, 33), (33, 33)])
+        for G in [self.graph, disconnected, multigraph]:
+            vbtheirs = G.betweenness()
+            vbmine = CONGA.vertex_betweenness_from_edges(G, G.edge_betweenness())
+            for v in G.vs:
+                self.assertAlmostEqual(vbtheirs[v.index], vbmine[v.index])
+
+
+    def test_removed_edge(self):
+        """
+        Runs CONGA one step at a time and checks that every edge removal
+        takes out the first edge with the max edge betweenness of the graph
+        as it stands, so no stale betweennesses steer the choice.
+        """
+        G = self.graph
+        G.vs['CONGA_comm'] = G.components().membership
+        while G.es:
+            eb = G.edge_betweenness()
+            expected = G.es[eb.index(max(eb))].tuple
+            before = G.get_edgelist()
+            vcount = G.vcount()
+            CONGA.remove_edge_or_split_vertex(G)
+            if G.vcount() == vcount:
+                after = G.get_edgelist()
+                self.assertEqual(len(after), len(before) - 1)
+                self.assertNotIn(expected, after)
+            self.assertEqual(len(set(G.vs['CONGA_comm'])), len(G.components()))
+
+
+    def test_split_without_membership(self):
+        """
+        Checks that delete_edge and split_vertex work on a graph conga
+        has not set 'CONGA_comm' on, and still report splits.
+        """
+        G = igraph.Graph.Ring(6)
+        G.vs['CONGA_orig'] = [i.index for i in G.vs]
+        self.assertFalse(CONGA.delete_edge(G, (0, 1)))
+        self.assertTrue(CONGA.delete_edge(G, (3, 4)))
+        self.assertTrue(CONGA.split_vertex(G, 5, [4]))
+        self.assertNotIn('CONGA_comm', G.vs.attributes())
+        self.assertEqual(G.vs[6]['CONGA_orig'], 5)
+
+        # both copies of a parallel edge move when the partner is listed twice
+        G = igraph.Graph([(0, 1), (0, 1), (0, 2), (0, 3)])
+        G.vs['CONGA_orig'] = [i.index for i in G.vs]
+        self.assertTrue(CONGA.split_vertex(G, 0, [1, 1]))
+        self.assertEqual(G.get_edgelist(), [(0, 2), (0, 3), (1, 4), (1, 4)])
+
+
+    def deleting_collapse(self, clique):
+        """
+        The greedy collapse as CONGA first did it: the row and column of the
+        lowest score are folded together and deleted from the matrix until
+        it is 2 x 2.
+        """
+        M = clique.copy()
+        groups = [[i] for i in range(M.shape[0])]
+        while M.size > 4:
+            np.fill_diagonal(M, np.inf)
+            i, j = np.unravel_index(M.argmin(), M.shape)
+            np.fill_diagonal(M, 0)
+            M[i, :] = M[j, :] + M[i, :]
+            M = np.delete(M, j, axis=0)
+            M[:, i] = M[:, j] + M[:, i]
+            M = np.delete(M, j, axis=1)
+            np.fill_diagonal(M, 0)
+            groups[i] += groups.pop(j)
+        return M[0, 1], groups
+
+
+    def test_collapse_clique(self):
+        """
+        Checks collapse_clique against deleting rows and columns, on random
+        symmetric matrices with and without tied scores.
+        """
+        rng = np.random.RandomState(0)
+        for k in range(2, 9):
+            for trial in range(50):
+                # small integer scores tie all the time
+                M = rng.randint(0, 4, (k, k)).astype(float) if trial % 2 else rng.rand(k, k)
+                M = M + M.T
+                np.fill_diagonal(M, 0)
+                score, groups = CONGA.collapse_clique(M.copy())
+                expected, expectedGroups = self.deleting_collapse(M)
+                self.assertEqual(score, expected)
+                self.assertEqual(groups, expectedGroups)
+
+
+    def test_reduce_matrix_sentinel(self):
+        """
+        Checks that reduce_matrix folds whole rows of pairIndex through the
+        infinite sentinel on its diagonal: the merged pair and the sentinel
+        end up infinite, and only the pairs of the surviving group are summed.
+        """
+        # pairs {0, 1}, {0, 2}, {1, 2}, then the sentinel
+        tri = np.array([1.0, 2.0, 4.0, np.inf])
+        pairIndex = np.array([[3, 0, 1], [0, 3, 2], [1, 2, 3]])
+        CONGA.reduce_matrix(tri, pairIndex, 0, 1)
+        self.assertEqual(tri.tolist(), [np.inf, 6.0, np.inf, np.inf])
+
+        # with every score tied at zero, collapsed pairs must never come back
+        for k in range(2, 9):
+            M = np.zeros((k, k))
+            self.assertEqual(CONGA.collapse_clique(M.copy()), self.deleting_collapse(M))
+
+
+    def test_pair_betweenness(self):
+        """
+        Checks to make sure that the sum of all pair betweennesses
+        on a specific vertex are equal to its vertex betweenness.
+        """
+        pb = CONGA.pair_betweenness(self.graph, list(range(self.graph.vcount())))
+        vb = self.graph.betweenness()
+        for v in pb:
+            self.assertAlmostEqual(pb[v].sum() / 2, vb[v])
+
+
+    def test_pair_betweenness_batches(self):
+        """
+        Checks that splitting the sources into small batches, serially
+        or on a thread pool, gives the same pair betweennesses.
+        """
+        relevant = list(range(self.graph.vcount()))
+        serial = CONGA.pair_betweenness(self.graph, relevant)
+        for kwargs in [{'batch_size' : 3}, {'workers' : 4}, {'batch_size' : 2, 'workers' : 3}]:
+            pb = CONGA.pair_betweenness(self.graph, relevant, **kwargs)
+            for v in relevant:
+                self.assertEqual(pb[v].shape, serial[v].shape)
+                for mine, theirs in zip(pb[v].ravel(), serial[v].ravel()):
+                    self.assertAlmostEqual(mine, theirs)
+
+
+    def test_pair_betweenness_disconnected(self):
+        """
+        Checks the pair betweennesses of a few vertices when the graph has
+        components without any of them.
+        """
+        G = self.graph.disjoint_union(igraph.Graph.Famous("petersen"))
+        G = G.disjoint_union(igraph.Graph.Ring(5))
+        relevant = [0, 33, 36, 42]
+        pb = CONGA.pair_betweenness(G, relevant)
+        vb = G.betweenness()
+        self.assertEqual(sorted(pb), relevant)
+        for v in relevant:
+            self.assertAlmostEqual(pb[v].sum() / 2, vb[v])
+
+
+if __name__ == '__main__':
+    unittest.main()
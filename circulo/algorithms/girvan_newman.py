@@ -70,7 +70,8 @@ def createDendrogram(G, splits):
 	Given a historical list of split edges, creates a dendrogram 
 	by calculating the merges. 
 
-	Runs in O(nlgn) (But really, close to O(n).) This is a useful function
+	Runs in O(nlgn) (But really, close to O(n).) Merges are kept as a
+	union-find forest with path compression. This is a useful function
 	for any divisive algorithm for which splits can be saved more easily
 	than merges.
 	"""
@@ -81,9 +82,8 @@ def createDendrogram(G, splits):
 
 	mergeDict = {}
 
-	while splits:
-		# most recent split popped off
-		edge = splits.pop()
+	# most recent split first
+	for edge in reversed(splits):
 
 		# Get the values the dendrogram wants for each vertex by finding
 		# where merges have already happened.
@@ -102,12 +102,16 @@ def createDendrogram(G, splits):
 
 def traverse(vertex, mergeDict):
 	"""
-	Given a vertex and a dictionaty of merges, returns the id of the cluster
-	the vertex belongs to.
+	Given a vertex and a dictionary of merges, returns the id of the cluster
+	the vertex belongs to. Every id on the way is pointed straight at that
+	cluster, so later lookups don't walk the same chain again.
 	"""
-	while vertex in mergeDict:
-		vertex = mergeDict[vertex]
-	return vertex
+	root = vertex
+	while root in mergeDict:
+		root = mergeDict[root]
+	while vertex != root:
+		mergeDict[vertex], vertex = root, mergeDict[vertex]
+	return root
 
 
 
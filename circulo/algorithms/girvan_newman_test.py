@@ -0,0 +1,43 @@
+import circulo.algorithms.girvan_newman as GN
+import unittest
+import random
+import igraph
+
+class TestGirvanNewmanFunctions(unittest.TestCase):
+
+    def walked_merges(self, splits):
+        """
+        The merges createDendrogram used to compute, walking every vertex up
+        the dict of merges without compressing the paths.
+        """
+        n = len(splits) + 1
+        merges = []
+        mergeDict = {}
+        for edge in reversed(splits):
+            edge = list(edge)
+            for i, vertex in enumerate(edge):
+                while vertex in mergeDict:
+                    vertex = mergeDict[vertex]
+                edge[i] = vertex
+            merges.append(edge)
+            for vertex in edge:
+                mergeDict[vertex] = n
+            n += 1
+        return merges
+
+
+    def test_create_dendrogram(self):
+        """
+        Checks the merges of createDendrogram against the plain walk on a
+        random tree split in random order, with the splits given as tuples.
+        """
+        random.seed(7)
+        G = igraph.Graph.Tree_Game(300)
+        splits = [e.tuple for e in G.es]
+        random.shuffle(splits)
+        merges = GN.createDendrogram(G, list(splits)).merges
+        self.assertEqual([list(m) for m in merges], self.walked_merges(splits))
+
+
+if __name__ == '__main__':
+    unittest.main()
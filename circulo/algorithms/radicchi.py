@@ -1,5 +1,8 @@
 import sys
+import heapq
 import igraph as ig
+import numpy as np
+import scipy.sparse as sp
 import itertools
 import argparse
 
@@ -24,49 +27,87 @@ def radicchi(G, measure='weak'):
 
     return ig.VertexClustering(G, clustering)
 
-def radicchi_internal(G, g, level, measure='strong', clustering=3):
+def radicchi_internal(G, g, level, measure='strong', clustering=3, adjlist=None):
     """
     Uses the Radicchi et al. algorithm to find the communities in a graph. Returns a list of the splits in the graph.
+    adjlist is the adjacency list of the original graph G; it is computed once and handed down the recursion.
     """
     # Caching some global graph information and updating it manually. Because igraph
     # tends to recalculate this stuff on the whole graph every time, 
     # storing it and manipulating only the parts that change will make things faster.
 
+    if adjlist is None:
+        adjlist = G.get_adjlist()
+
     degree = g.degree()
     neighbors = [set(g.neighbors(v)) for v in g.vs]
     edges = {e.tuple for e in g.es}
     n_components = len(g.components())
 
+    # The number of triangles on each edge is kept up to date as edges are
+    # removed, so the edge clustering coefficients never need a full recount.
+    # The initial counts for every edge come from one sparse matrix product.
+    triangles = None
     if clustering == 3:
+        triangles = count_triangles(edges, neighbors)
+        initial_counts = triangles
         edge_clustering_coefficient = edge_clustering_coefficient_3 
     else:
+        initial_counts = count_squares(edges, neighbors)
         edge_clustering_coefficient = edge_clustering_coefficient_4
 
+    ecc = {e: edge_clustering_coefficient(e[0], e[1], degree, neighbors, initial_counts) for e in edges}
+
+    # Min-heap of (ecc, edge). Entries are never removed when an edge is deleted or
+    # its coefficient changes; stale ones are skipped when they reach the top.
+    heap = [(c, e) for e, c in ecc.items()]
+    heapq.heapify(heap)
+
+    # Whether removing edges splits a component is checked by searching the neighbor
+    # sets around them. Only when that would visit a sizeable part of the graph (say,
+    # for a large batch of tied edges) is g brought up to date to count its components
+    # instead; removed edges are deleted from g in bulk at that point.
+    removed = []
+
     communities = []
     while True:
         if len(edges) == 0:
             break
 
-        min_edges = []; min_ecc = None
-        for e in edges:
-            ecc = edge_clustering_coefficient(e[0], e[1], degree, neighbors)
-            if not min_ecc or ecc < min_ecc:
-                min_edges = [e]
-                min_ecc = ecc
-            elif ecc == min_ecc:
-                min_edges.append(e)
+        min_edges = pop_min_edges(heap, ecc)
 
-        g.delete_edges(min_edges); 
+        removed.extend(min_edges)
+        changed = set()
         for min_edge in min_edges:
             edges.discard(min_edge)
+            del ecc[min_edge]
             u, v = min_edge
+            if triangles is not None:
+                for w in neighbors[u] & neighbors[v]:
+                    triangles[edge_key(u, w)] -= 1
+                    if u != v:
+                        triangles[edge_key(v, w)] -= 1
+                del triangles[min_edge]
             neighbors[u].discard(v); neighbors[v].discard(u)
             degree[u] -= 1; degree[v] -= 1
-
-        n_components_new = len(g.components())
+            changed.update(affected_edges(u, v, neighbors, clustering))
+
+        for e in changed & edges:
+            new_ecc = edge_clustering_coefficient(e[0], e[1], degree, neighbors, triangles)
+            if new_ecc != ecc[e]:
+                ecc[e] = new_ecc
+                heapq.heappush(heap, (new_ecc, e))
+
+        # connected gives None when it gives up, which also brings g up to date
+        n_components_new = n_components
+        max_visits = len(neighbors) // (4 * len(min_edges))
+        if not all(connected(u, v, neighbors, max_visits) for u, v in min_edges):
+            g.delete_edges(removed)
+            removed = []
+            n_components_new = len(g.components())
 
         if n_components_new > n_components:
-            result = prune_components(G, g, community_measure=measure)
+            result = prune_components(G, g, community_measure=measure, adjlist=adjlist)
             n_components = n_components_new
             if result['pruned']:
                 orig_communities = result['orig_communities']
@@ -75,7 +116,7 @@ def radicchi_internal(G, g, level, measure='strong', clustering=3):
 
                 for i,c in enumerate(new_communities):
                     s = g.subgraph(c)
-                    subcommunities = radicchi_internal(G, s, level+1, measure)
+                    subcommunities = radicchi_internal(G, s, level+1, measure, adjlist=adjlist)
                     if len(subcommunities) == 0:
                         communities.append(orig_communities[i])
                     else:
@@ -83,7 +124,7 @@ def radicchi_internal(G, g, level, measure='strong', clustering=3):
 
                 orig_remaining = [g.vs[i]['id'] for i in remaining]
                 r = g.subgraph(remaining)
-                subcommunities = radicchi_internal(G, r, level+1, measure)
+                subcommunities = radicchi_internal(G, r, level+1, measure, adjlist=adjlist)
                 clustered = sum(subcommunities, [])
                 isolated_remaining = [i for i in orig_remaining if i not in clustered]
                 communities.extend([[i] for i in isolated_remaining])
@@ -92,9 +133,10 @@ def radicchi_internal(G, g, level, measure='strong', clustering=3):
 
     return communities
 
-def prune_components(orig, new, community_measure='strong'):
+def prune_components(orig, new, community_measure='strong', adjlist=None):
     """ Uses the given community measure to prune connected components in the graph new that
-        represent communities in the graph orig, using the given community measure.  """
+        represent communities in the graph orig, using the given community measure. adjlist
+        is an optional cached adjacency list of orig. """
     components = new.components()
     ids = new.vs['id']
 
@@ -102,7 +144,7 @@ def prune_components(orig, new, community_measure='strong'):
     orig_components = [[ids[v] for v in component] for component in new_components]
 
     is_community = is_strong_community if (community_measure=='strong') else is_weak_community
-    community_indices = [i for i, component in enumerate(orig_components) if is_community(orig, component)]
+    community_indices = [i for i, component in enumerate(orig_components) if is_community(orig, component, adjlist)]
 
     orig_communities = [orig_components[i] for i in community_indices]
     new_communities = [new_components[i] for i in community_indices]
@@ -124,38 +166,184 @@ def prune_components(orig, new, community_measure='strong'):
     return {"pruned": result_pruned, "orig_communities": result_orig_communities, 
             "new_communities": result_new_communities, "remaining": result_remaining_nodes}
 
-def is_strong_community(G, nodes):
+def community_degrees(G, nodes, adjlist=None):
+    """
+    Returns the degrees of the given nodes in the graph G and in the subgraph they induce.
+    With a cached adjacency list of G, the in-community degrees are counted from it
+    instead of building the subgraph.
+    """
+    if adjlist is None:
+        return G.degree(nodes), G.subgraph(nodes).degree()
+    members = set(nodes)
+    degree = [len(adjlist[v]) for v in nodes]
+    community_degree = [sum(1 for w in adjlist[v] if w in members) for v in nodes]
+    return degree, community_degree
+
+def is_strong_community(G, nodes, adjlist=None):
     """
     Checks whether the provided set of nodes form a strong community in the graph G.
     """
     # precondition: nodes must be sorted
-    subgraph = G.subgraph(nodes)
-    degree = G.degree(nodes)
-    community_degree = subgraph.degree()
+    degree, community_degree = community_degrees(G, nodes, adjlist)
     for i in range(len(nodes)):
         if community_degree[i] <= (degree[i] - community_degree[i]):
             return False
 
     return True
 
-def is_weak_community(G, nodes):
+def is_weak_community(G, nodes, adjlist=None):
     """
     Checks whether the provided set of nodes form a weak community in the graph G.
     """
     # precondition: nodes must be sorted
-    subgraph = G.subgraph(nodes)
-    degree = G.degree(nodes)
-    indegree = subgraph.degree()
+    degree, indegree = community_degrees(G, nodes, adjlist)
     tsum = sum(degree)
     insum = sum(indegree)
     outsum = tsum - insum
 
     return insum > outsum
 
-def edge_clustering_coefficient_3(u, v, degree, neighbors):
+def pop_min_edges(heap, ecc):
+    """
+    Pops every edge tied for the minimum clustering coefficient off the heap, skipping
+    entries for deleted edges or outdated coefficients. ecc maps live edges to their
+    current coefficient.
+    """
+    min_edges = set()
+    min_ecc = None
+    while heap:
+        c, e = heap[0]
+        if ecc.get(e) != c or e in min_edges:
+            heapq.heappop(heap)
+        elif not min_edges or c == min_ecc:
+            heapq.heappop(heap)
+            min_edges.add(e)
+            min_ecc = c
+        else:
+            break
+    return list(min_edges)
+
+def connected(u, v, neighbors, max_visits=None):
+    """
+    Checks whether u and v are connected in the graph given by the neighbor sets. Searches
+    outwards from both vertices, always growing the smaller frontier, so a disconnected pair
+    costs about as much as the smaller of their components. Returns None if the search
+    gives up after visiting more than max_visits vertices.
+    """
+    if u == v:
+        return True
+    seen = [{u}, {v}]
+    frontiers = [[u], [v]]
+    while frontiers[0] and frontiers[1]:
+        if max_visits is not None and len(seen[0]) + len(seen[1]) > max_visits:
+            return None
+        side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+        mine, other = seen[side], seen[1 - side]
+        frontier = []
+        for w in frontiers[side]:
+            for x in neighbors[w]:
+                if x in other:
+                    return True
+                if x not in mine:
+                    mine.add(x)
+                    frontier.append(x)
+        frontiers[side] = frontier
+    return False
+
+def edge_key(u, v):
+    """
+    Returns the edge between u and v as the (smaller, larger) tuple igraph uses.
+    """
+    return (u, v) if u <= v else (v, u)
+
+def affected_edges(u, v, neighbors, clustering=3):
+    """
+    Returns the edges whose clustering coefficient may change when the edge (u, v) is removed:
+    those sharing an endpoint with it and, when counting squares, those closing a square with it.
+    """
+    affected = {edge_key(u, w) for w in neighbors[u]} | {edge_key(v, w) for w in neighbors[v]}
+    if clustering != 3:
+        for a in neighbors[u]:
+            affected.update(edge_key(a, b) for b in neighbors[a] & neighbors[v])
+    return affected
+
+def neighbor_matrix(neighbors):
+    """
+    Returns the 0/1 adjacency matrix of the given neighbor sets in CSR form, so that
+    row v holds the neighbors of v as a sorted int32 array.
+    """
+    n = len(neighbors)
+    indptr = np.zeros(n + 1, dtype=np.int32)
+    indptr[1:] = np.cumsum([len(s) for s in neighbors])
+    indices = np.fromiter((w for s in neighbors for w in sorted(s)), dtype=np.int32, count=indptr[-1])
+    return sp.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(n, n))
+
+def neighbor_bits(neighbors):
+    """
+    Returns the adjacency of the given neighbor sets as a bit matrix, with row v packed
+    into ceil(n/64) uint64 words and bit w set when w is a neighbor of v.
+    """
+    n = len(neighbors)
+    src = np.repeat(np.arange(n), [len(s) for s in neighbors])
+    dst = np.fromiter((w for s in neighbors for w in s), dtype=np.int64, count=len(src))
+    bits = np.zeros((n, (n + 63) // 64), dtype=np.uint64)
+    np.bitwise_or.at(bits, (src, dst >> 6), np.left_shift(np.uint64(1), (dst & 63).astype(np.uint64)))
+    return bits
+
+def popcount(words):
+    """
+    Returns the number of set bits in each row of a matrix of uint64 words.
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=1, dtype=int)
+    return POPCOUNT_8[words.view(np.uint8)].sum(axis=1, dtype=int)
+
+POPCOUNT_8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+BIT_ADJACENCY_MAX_VERTICES = 4096
+
+def count_triangles(edges, neighbors):
+    """
+    Returns a dict with the number of triangles on each of the given edges, that is,
+    the number of neighbors its endpoints share. On graphs with up to BIT_ADJACENCY_MAX_VERTICES
+    vertices the shared neighbors are counted as set bits in the AND of bit-packed neighbor
+    rows; larger graphs use sparse matrix products.
+    """
+    edges = list(edges)
+    if not edges:
+        return {}
+    u, v = np.array(edges).T
+    if len(neighbors) <= BIT_ADJACENCY_MAX_VERTICES:
+        bits = neighbor_bits(neighbors)
+        # AND the rows in chunks so the intermediate stays around a million words
+        chunk = max(1, 2**20 // bits.shape[1])
+        counts = np.concatenate([popcount(bits[u[i:i + chunk]] & bits[v[i:i + chunk]])
+                                 for i in range(0, len(edges), chunk)])
+    else:
+        B = neighbor_matrix(neighbors)
+        counts = np.asarray(B[u].multiply(B[v]).sum(axis=1)).ravel().astype(int)
+    return dict(zip(edges, counts.tolist()))
+
+def count_squares(edges, neighbors):
+    """
+    Returns a dict with the number of squares on each of the given edges, as counted by
+    edge_clustering_coefficient_4. Paths u-w-x-v of length three are counted by B^3,
+    less the ones that double back over the edge itself.
+    """
+    edges = list(edges)
+    if not edges:
+        return {}
+    u, v = np.array(edges).T
+    B = neighbor_matrix(neighbors)
+    paths = np.asarray((B @ B)[u].multiply(B[v]).sum(axis=1)).ravel().astype(int)
+    sizes = np.array([len(s) for s in neighbors])
+    counts = paths - sizes[u] - sizes[v] + 1
+    return dict(zip(edges, counts.tolist()))
+
+def edge_clustering_coefficient_3(u, v, degree, neighbors, triangles=None):
     """
     Computes the "edge clustering coefficient" of the given edge, defined as the number of triangles
     in which it participates compared to the maximum number of triangles of which it could be a part.
+    If a dict of triangle counts per edge is given, it is used instead of intersecting neighbor sets.
     """
     udeg = degree[u]
     vdeg = degree[v]
@@ -163,12 +351,16 @@ def edge_clustering_coefficient_3(u, v, degree, neighbors):
     if mdeg == 0:
         return float('inf')
     else:
-        cdeg = len(neighbors[u] & neighbors[v])
+        if triangles is not None:
+            cdeg = triangles[edge_key(u, v)]
+        else:
+            cdeg = len(neighbors[u] & neighbors[v])
         return (cdeg + 1.0) / mdeg
 
-def edge_clustering_coefficient_4(u, v, degree, neighbors):
+def edge_clustering_coefficient_4(u, v, degree, neighbors, squares=None):
     """
     Computes a modified form of the edge clustering coefficient using squares instead of triangles.
+    If a dict of square counts per edge is given, it is used instead of intersecting neighbor sets.
     """
     udeg = degree[u]
     vdeg = degree[v]
@@ -176,6 +368,9 @@ def edge_clustering_coefficient_4(u, v, degree, neighbors):
     if mdeg == 0:
         return float('inf')
     else:
+        if squares is not None:
+            return (squares[edge_key(u, v)] + 1.0) / mdeg
+
         uneighbors = neighbors[u] - {v}
         vneighbors = neighbors[v] - {u} 
 
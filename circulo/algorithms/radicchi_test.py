@@ -0,0 +1,229 @@
+import circulo.algorithms.radicchi as RADICCHI
+import unittest
+import igraph
+import heapq
+import numpy as np
+
+class TestRadicchiFunctions(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Initializes the graphs for testing to Zachary's karate club
+        and a disconnected graph with self loops and an isolated vertex.
+        """
+        self.graph = igraph.Graph.Famous("zachary")
+        self.disconnected = self.graph.disjoint_union(igraph.Graph.Famous("frucht"))
+        self.disconnected.add_vertices(1)
+        self.disconnected.add_edges([(0, 0), (5, 5), (40, 40)])
+
+
+    def tearDown(self):
+        self.graph = None
+        self.disconnected = None
+
+
+    def recomputed_internal(self, G, g, measure, clustering=3):
+        """
+        radicchi_internal as it was before the counts were kept up to date:
+        every edge clustering coefficient is recomputed from the neighbor
+        sets on every pass.
+        """
+        degree = g.degree()
+        neighbors = [set(g.neighbors(v)) for v in g.vs]
+        edges = {e.tuple for e in g.es}
+        n_components = len(g.components())
+        edge_clustering_coefficient = RADICCHI.edge_clustering_coefficient_3 if clustering == 3 \
+                                      else RADICCHI.edge_clustering_coefficient_4
+
+        communities = []
+        while edges:
+            ecc = {e : edge_clustering_coefficient(e[0], e[1], degree, neighbors) for e in edges}
+            min_ecc = min(ecc.values())
+            min_edges = [e for e in edges if ecc[e] == min_ecc]
+
+            g.delete_edges(min_edges)
+            for u, v in min_edges:
+                edges.discard((u, v))
+                neighbors[u].discard(v); neighbors[v].discard(u)
+                degree[u] -= 1; degree[v] -= 1
+
+            n_components_new = len(g.components())
+            if n_components_new > n_components:
+                result = RADICCHI.prune_components(G, g, community_measure=measure)
+                n_components = n_components_new
+                if result['pruned']:
+                    for i, c in enumerate(result['new_communities']):
+                        subcommunities = self.recomputed_internal(G, g.subgraph(c), measure)
+                        if len(subcommunities) == 0:
+                            communities.append(result['orig_communities'][i])
+                        else:
+                            communities.extend(subcommunities)
+
+                    remaining = result['remaining']
+                    orig_remaining = [g.vs[i]['id'] for i in remaining]
+                    clustered = sum(self.recomputed_internal(G, g.subgraph(remaining), measure), [])
+                    communities.extend([[i] for i in orig_remaining if i not in clustered])
+                    break
+
+        return communities
+
+
+    def recomputed(self, G, measure):
+        """
+        Runs recomputed_internal the way radicchi runs radicchi_internal and
+        returns the membership list.
+        """
+        g = G.copy()
+        g.vs['id'] = list(range(g.vcount()))
+        result = self.recomputed_internal(G, g, measure, clustering=4 if measure == 'weak' else 3)
+        membership = [0] * G.vcount()
+        for i, community in enumerate(result):
+            for v in community:
+                membership[v] = i
+        return membership
+
+
+    def test_radicchi(self):
+        """
+        Checks that radicchi finds the same communities as recomputing every
+        edge clustering coefficient on every pass, for both measures.
+        """
+        for G in [self.graph, self.disconnected]:
+            for measure in ['strong', 'weak']:
+                self.assertEqual(RADICCHI.radicchi(G, measure).membership, self.recomputed(G, measure))
+
+
+    def test_pop_min_edges(self):
+        """
+        Checks that pop_min_edges pops every edge tied for the minimum,
+        skipping entries for deleted edges, outdated coefficients and
+        edges pushed more than once.
+        """
+        ecc = {(0, 1) : 0.5, (1, 2) : 0.5, (2, 3) : 0.75}
+        heap = [(0.25, (3, 4)), (0.3, (2, 3)), (0.5, (0, 1)), (0.5, (0, 1)),
+                (0.5, (1, 2)), (0.75, (2, 3)), (0.75, (2, 3))]
+        heapq.heapify(heap)
+        self.assertEqual(sorted(RADICCHI.pop_min_edges(heap, ecc)), [(0, 1), (1, 2)])
+        del ecc[(0, 1)]; del ecc[(1, 2)]
+        self.assertEqual(RADICCHI.pop_min_edges(heap, ecc), [(2, 3)])
+        del ecc[(2, 3)]
+        self.assertEqual(RADICCHI.pop_min_edges(heap, ecc), [])
+        self.assertEqual(heap, [])
+
+
+    def test_connected(self):
+        """
+        Checks that connected tells connected and disconnected pairs apart,
+        and gives up with None once it has visited more than max_visits
+        vertices.
+        """
+        neighbors = self.neighbor_sets(igraph.Graph.Ring(20, circular=False) + igraph.Graph.Ring(5))
+        self.assertTrue(RADICCHI.connected(0, 19, neighbors))
+        self.assertTrue(RADICCHI.connected(3, 3, neighbors, 0))
+        self.assertFalse(RADICCHI.connected(0, 22, neighbors))
+        self.assertFalse(RADICCHI.connected(21, 5, neighbors, 100))
+        self.assertIsNone(RADICCHI.connected(0, 19, neighbors, 4))
+        self.assertTrue(RADICCHI.connected(0, 19, neighbors, 20))
+
+
+    def test_radicchi_gives_up(self):
+        """
+        Checks that radicchi finds the same communities whether the split
+        checks finish or give up and count the components of the graph.
+        """
+        connected = RADICCHI.connected
+        results = set()
+        def recording(u, v, neighbors, max_visits=None):
+            result = connected(u, v, neighbors, max_visits)
+            results.add(result)
+            return result
+        def searching(u, v, neighbors, max_visits=None):
+            return recording(u, v, neighbors)
+        def giving_up(u, v, neighbors, max_visits=None):
+            return recording(u, v, neighbors, 0)
+
+        try:
+            for check in [searching, giving_up]:
+                RADICCHI.connected = check
+                for measure in ['strong', 'weak']:
+                    self.assertEqual(RADICCHI.radicchi(self.disconnected, measure).membership,
+                                     self.recomputed(self.disconnected, measure))
+        finally:
+            RADICCHI.connected = connected
+        self.assertEqual(results, {True, False, None})
+
+
+    def neighbor_sets(self, G):
+        """
+        Returns the neighbors of every vertex of G as sets.
+        """
+        return [set(G.neighbors(v)) for v in G.vs]
+
+
+    def test_count_triangles_sparse(self):
+        """
+        Checks the sparse matrix triangle counts against intersecting
+        neighbor sets.
+        """
+        limit = RADICCHI.BIT_ADJACENCY_MAX_VERTICES
+        RADICCHI.BIT_ADJACENCY_MAX_VERTICES = 0
+        try:
+            for G in [self.graph, self.disconnected]:
+                neighbors = self.neighbor_sets(G)
+                edges = [e.tuple for e in G.es]
+                triangles = RADICCHI.count_triangles(edges, neighbors)
+                for u, v in edges:
+                    self.assertEqual(triangles[(u, v)], len(neighbors[u] & neighbors[v]))
+        finally:
+            RADICCHI.BIT_ADJACENCY_MAX_VERTICES = limit
+
+
+    def test_count_triangles_bits(self):
+        """
+        Checks the bit-packed triangle counts against intersecting neighbor
+        sets, with the popcount done by numpy and by the byte table used on
+        numpy versions without bitwise_count.
+        """
+        bitwise_count = getattr(np, 'bitwise_count', None)
+        for table in [False, True]:
+            if table and bitwise_count is not None:
+                del np.bitwise_count
+            try:
+                for G in [self.graph, self.disconnected]:
+                    neighbors = self.neighbor_sets(G)
+                    edges = [e.tuple for e in G.es]
+                    triangles = RADICCHI.count_triangles(edges, neighbors)
+                    for u, v in edges:
+                        self.assertEqual(triangles[(u, v)], len(neighbors[u] & neighbors[v]))
+            finally:
+                if bitwise_count is not None:
+                    np.bitwise_count = bitwise_count
+
+
+    def test_popcount_table(self):
+        """
+        Checks the byte table popcount on words with the high bits set.
+        """
+        words = np.array([[0, 1, 2**63], [2**64 - 1, 2**32 + 5, 0]], dtype=np.uint64)
+        expected = [sum(bin(int(w)).count('1') for w in row) for row in words]
+        self.assertEqual(RADICCHI.POPCOUNT_8[words.view(np.uint8)].sum(axis=1, dtype=int).tolist(), expected)
+        self.assertEqual(RADICCHI.popcount(words).tolist(), expected)
+
+
+    def test_count_squares(self):
+        """
+        Checks that the square counts give the same edge clustering
+        coefficients as counting squares on the neighbor sets.
+        """
+        for G in [self.graph, self.disconnected]:
+            neighbors = self.neighbor_sets(G)
+            degree = G.degree()
+            edges = [e.tuple for e in G.es]
+            squares = RADICCHI.count_squares(edges, neighbors)
+            for u, v in edges:
+                self.assertEqual(RADICCHI.edge_clustering_coefficient_4(u, v, degree, neighbors, squares),
+                                 RADICCHI.edge_clustering_coefficient_4(u, v, degree, neighbors))
+
+
+if __name__ == '__main__':
+    unittest.main()